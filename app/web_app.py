@@ -1,23 +1,25 @@
 # app/web_app.py
 
-import base64
+import atexit
+import binascii
 import os
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache, wraps
 from typing import Tuple, Optional
 
 import cv2
 import numpy as np
 from flask import Flask, render_template, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if BASE_DIR not in sys.path:
     sys.path.append(BASE_DIR)
 
-from src.face_recognizer import DeepFaceRecognizer
-from src.face_detector import FaceDetector
-from src.liveness import LivenessDetector
 import src.db_utils as db
 from src.logger import get_logger
 from src.custom_exceptions import (
@@ -28,31 +30,161 @@ from src.custom_exceptions import (
 
 logger = get_logger(__name__)
 
+# libjpeg-turbo decoder (optional). Fallback: cv2.imdecode
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _turbo_jpeg = TurboJPEG()
+except Exception as e:  # PyTurboJPEG / libturbojpeg chưa được cài
+    _turbo_jpeg = None
+    logger.info(f"TurboJPEG unavailable, using cv2.imdecode ({e})")
+
 app = Flask(
     __name__,
     template_folder=os.path.join(BASE_DIR, "templates"),
     static_folder=os.path.join(BASE_DIR, "static"),
 )
 
-# Khởi tạo DB (nếu chưa có)
-db.init_db()
+# orjson (optional) cho jsonify: nhanh hơn json chuẩn nhiều lần với list-of-dict
+try:
+    import orjson
+
+    class OrjsonProvider(DefaultJSONProvider):
+        """JSON provider dùng orjson, fallback default() của Flask cho type lạ."""
 
-# Khởi tạo AI Models
-face_detector = FaceDetector()
-liveness_detector = LivenessDetector()
-recognizer = DeepFaceRecognizer(model_name="ArcFace")
+        def dumps(self, obj, **kwargs) -> str:
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+            return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
 
-logger.info("AI Models initialized (Detector, Liveness, Recognizer)")
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
 
-def decode_base64_image(base64_string):
+    app.json = OrjsonProvider(app)
+except ImportError:
+    pass
 
+# Static assets: cache lâu dài ở browser; URL có ?v=<mtime> nên file mới vẫn được tải lại
+@app.url_defaults
+def _static_cache_buster(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        try:
+            values['v'] = int(os.stat(os.path.join(app.static_folder, values['filename'])).st_mtime)
+        except OSError:
+            pass
+
+@app.after_request
+def _static_cache_headers(response):
+    if request.path.startswith('/static/'):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# Khởi tạo DB (nếu chưa có). Đóng connection của thread import ngay: với
+# gunicorn --preload, worker fork ra không được dùng lại connection của process cha.
+db.init_db()
+db.close_connection()
+atexit.register(db.close_all_connections)
+
+# Số face tối đa mỗi batch ArcFace của embedding streamer (override bằng env EMBED_BATCH_SIZE)
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "8"))
+
+# Worker pool riêng cho AI inference: số thread HTTP != số thread chạy model.
+# Mỗi request nhận diện chiếm 1 worker khi chờ streamer, nên cần đủ EMBED_BATCH_SIZE
+# worker thì các frame đồng thời mới gom được thành batch đầy.
+_model_executor = ThreadPoolExecutor(max_workers=EMBED_BATCH_SIZE, thread_name_prefix="model")
+# Ghi file ảnh (JPEG encode + I/O) ngoài thread HTTP
+_io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="io")
+
+# --- AI Models (lazy) ---
+# Model chỉ được load (và import DeepFace/TensorFlow) ở lần gọi đầu tiên,
+# nên worker không phục vụ nhận diện sẽ không tốn RAM cho ArcFace.
+# RLock: get_embedding_streamer() gọi get_recognizer() khi đang giữ lock.
+_model_lock = threading.RLock()
+
+def _lazy_model(factory):
+    """Thread-safe lazy singleton: factory chỉ chạy đúng 1 lần."""
+    cached = lru_cache(maxsize=None)(factory)
+
+    @wraps(factory)
+    def getter():
+        with _model_lock:
+            return cached()
+    return getter
+
+@_lazy_model
+def get_face_detector():
+    from src.face_detector import FaceDetector
+    return FaceDetector()
+
+@_lazy_model
+def get_liveness_detector():
+    from src.liveness import LivenessDetector
+    return LivenessDetector()
+
+@_lazy_model
+def get_recognizer():
+    from src.face_recognizer import DeepFaceRecognizer
+    return DeepFaceRecognizer(model_name="ArcFace")
+
+@_lazy_model
+def get_embedding_streamer():
+    """Gom các face đồng thời thành batch cho ArcFace (tối đa EMBED_BATCH_SIZE face / 10ms)."""
+    from src.streamer import Streamer
+    return Streamer(get_recognizer().extract_embedding_batch, batch_size=EMBED_BATCH_SIZE, max_latency=0.01)
+
+# Ngưỡng nhận diện (Cosine Similarity) cho ArcFace với ảnh đã align,
+# tương đương Cosine Distance < 0.40.
+# NOTE: You MUST re-enroll employees for this to work effectively!
+RECOGNITION_THRESHOLD = 0.60
+
+# Detector chỉ cần ~640px cạnh dài; frame lớn hơn được thu nhỏ trước khi detect
+MAX_FRAME_SIDE = 640
+
+def decode_image_bytes(img_bytes, max_side: Optional[int] = None) -> Optional[np.ndarray]:
+    """
+    Decode JPEG/PNG bytes -> BGR image. JPEG đi qua TurboJPEG nếu có.
+    max_side: nếu ảnh JPEG lớn hơn 2x max_side, decode luôn ở 1/2 kích thước.
+    """
+    if _turbo_jpeg is not None and img_bytes[:2] == b"\xff\xd8":
+        scaling_factor = None
+        if max_side:
+            width, height, _, _ = _turbo_jpeg.decode_header(img_bytes)
+            if max(width, height) >= 2 * max_side:
+                scaling_factor = (1, 2)
+        return _turbo_jpeg.decode(img_bytes, pixel_format=TJPF_BGR, scaling_factor=scaling_factor)
+    np_arr = np.frombuffer(img_bytes, np.uint8)
+    return cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+
+def downscale_frame(bgr: Optional[np.ndarray], max_side: int = MAX_FRAME_SIDE) -> Optional[np.ndarray]:
+    """Thu nhỏ frame để cạnh dài <= max_side (giữ nguyên nếu đã nhỏ hơn)."""
+    if bgr is None:
+        return None
+    h, w = bgr.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1.0:
+        return bgr
+    return cv2.resize(bgr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+def _log_write_failure(future, path: str):
+    """Callback của _io_pool: log lỗi nếu ghi ảnh ở background thất bại."""
     try:
-        if "," in base64_string:
-            base64_string = base64_string.split(",")[1]
-        img_bytes = base64.b64decode(base64_string)
-        np_arr = np.frombuffer(img_bytes, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        return img
+        if not future.result():
+            logger.error(f"Failed to write image: {path}")
+    except Exception as e:
+        logger.error(f"Failed to write image {path}: {e}")
+
+def decode_base64_image(base64_string, max_side: Optional[int] = None):
+    """
+    Decode data-URL / base64 (str, bytes hoặc memoryview) -> BGR image.
+    Chỉ tìm dấu ',' trong phần header của data-URL, không quét cả payload.
+    """
+    try:
+        if isinstance(base64_string, str):
+            comma = base64_string.find(",", 0, 64)
+        else:
+            base64_string = memoryview(base64_string)
+            comma = bytes(base64_string[:64]).find(b",")
+        payload = base64_string[comma + 1:] if comma != -1 else base64_string
+        img_bytes = binascii.a2b_base64(payload)
+        return decode_image_bytes(img_bytes, max_side=max_side)
     except Exception:
         return None
 
@@ -61,12 +193,9 @@ def _handle_attendance(employee_id: Optional[int], score: float) -> dict:
     Xử lý kết quả nhận diện và log chấm công.
     Returns: dictionary with attendance info for frontend.
     """
-    # Recognition threshold
-    # Score is converted from distance: score = 1 - distance
-    # With new threshold 0.40: score must be > 0.60 (60% similarity)
-    RECOGNITION_THRESHOLD = 0.60 
-    
-    if employee_id is None or score < RECOGNITION_THRESHOLD:
+    # score = cosine similarity; ngưỡng đã được áp dụng trong find_best_match_matrix,
+    # employee_id là None nếu score không vượt RECOGNITION_THRESHOLD
+    if employee_id is None:
         # Unknown person
         db.log_attendance_event(
             employee_id=None,
@@ -87,28 +216,27 @@ def _handle_attendance(employee_id: Optional[int], score: float) -> dict:
     # Known employee
     emp = db.get_employee_by_id(employee_id)
     if not emp:
+        logger.warning(f"Matched employee {employee_id} not found in database")
         return {"name": "Unknown", "message": "Lỗi dữ liệu", "score": score, "is_unknown": True}
+    logger.info(f"✓ Matched to: {emp['name']} (ID: {employee_id})")
     
     # Determine check type (IN/OUT) - simple toggle logic
     last_log = db.get_last_attendance_for_employee(employee_id)
     check_type = "OUT" if last_log and last_log.get('check_type') == "IN" else "IN"
     
-    # Log attendance
+    # Log attendance (dùng lại last_log, không query lại)
     try:
-        db.log_attendance_event(
+        late_minutes = db.log_attendance_event(
             employee_id=employee_id,
             code=emp['code'],
             name=emp['name'],
             check_type=check_type,
             score=score,
             is_unknown=False,
-            validate_timing=True  # This will enforce 30s gap
+            validate_timing=True,  # This will enforce 30s gap
+            last_record=last_log
         )
         
-        # Get late info (if any)
-        last_log = db.get_last_attendance_for_employee(employee_id)
-        late_minutes = last_log.get('late_minutes', 0) if last_log else 0
-        
         status_msg = f"Trễ {late_minutes:.0f} phút" if late_minutes > 0 else "Đúng giờ"
         
         return {
@@ -236,7 +364,7 @@ def api_capture_face():
         bgr_image = decode_base64_image(image_data)
         
         # 2. Detect & Align
-        aligned_face = face_detector.align_face(bgr_image)
+        aligned_face = get_face_detector().align_face(bgr_image)
         if aligned_face is None:
              return jsonify({"error": "No face detected. Please look straight at the camera."}), 400
 
@@ -245,12 +373,14 @@ def api_capture_face():
         rel_path = os.path.join("data", "faces", filename)
         abs_path = os.path.join(BASE_DIR, rel_path)
         os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-        cv2.imwrite(abs_path, aligned_face) # Save aligned face
+        # Save aligned face ở background, không chặn response
+        future = _io_pool.submit(cv2.imwrite, abs_path, aligned_face, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        future.add_done_callback(lambda f, path=abs_path: _log_write_failure(f, path))
         
         db.add_face_image(employee_id, rel_path)
 
         # 4. Extract Embedding & Save to DB
-        embedding = recognizer.extract_embedding(aligned_face)
+        embedding = get_embedding_streamer().predict([aligned_face])[0]
         if embedding is None:
              return jsonify({"error": "Could not extract face features."}), 400
              
@@ -279,48 +409,90 @@ def api_recognize_webcam():
     if not image_data:
         return jsonify({"error": "No image data"}), 400
 
+    return _recognize_frame(
+        decode_base64_image(image_data, max_side=MAX_FRAME_SIDE), _stream_key(data.get('stream_id'))
+    )
+
+@app.route('/api/recognize_webcam_raw', methods=['POST'])
+def api_recognize_webcam_raw():
+    """
+    Giống /api/recognize_webcam nhưng nhận ảnh JPEG thô qua multipart/form-data
+    (field 'image'), bỏ qua bước base64.
+    """
+    image_file = request.files.get('image')
+    if image_file is None:
+        return jsonify({"error": "No image data"}), 400
+
     try:
-        bgr = decode_base64_image(image_data)
-        
-        # 1. Liveness Check
-        is_alive, liveness_msg = liveness_detector.check_liveness(bgr)
-        if not is_alive:
-             return jsonify({"success": False, "message": liveness_msg, "liveness_failed": True})
+        bgr = decode_image_bytes(image_file.read(), max_side=MAX_FRAME_SIDE)
+    except Exception as e:
+        logger.warning(f"Invalid image upload: {e}")
+        return jsonify({"success": False, "message": "Invalid image"}), 400
 
-        # 2. Detect & Align
-        aligned_face = face_detector.align_face(bgr)
-        if aligned_face is None:
-            return jsonify({"success": False, "message": "No face detected"})
+    return _recognize_frame(bgr, _stream_key(request.form.get('stream_id')))
 
-        # 3. Extract Embedding
-        target_embedding = recognizer.extract_embedding(aligned_face)
+def _stream_key(stream_id) -> Optional[str]:
+    """
+    Key cho việc dùng lại embedding giữa các frame: stream_id do client tự sinh
+    (mỗi trang camera 1 id). Không có id hợp lệ thì None -> không dùng lại, vì
+    sau reverse proxy remote_addr của mọi kiosk đều giống nhau.
+    """
+    if isinstance(stream_id, str) and 0 < len(stream_id) <= 64:
+        return stream_id
+    return None
+
+def _run_pipeline(bgr: Optional[np.ndarray], client_key: Optional[str] = None) -> dict:
+    """
+    Phần AI của pipeline nhận diện (chạy trên _model_executor):
+    Liveness -> Detect & Align -> Extract Embedding -> Compare with DB.
+    Returns: {"failure": response_dict} hoặc {"best_id", "best_sim", "liveness"}
+    """
+    bgr = downscale_frame(bgr)
+
+    # 1. Liveness Check
+    is_alive, liveness_msg = get_liveness_detector().check_liveness(bgr)
+    if not is_alive:
+        return {"failure": {"success": False, "message": liveness_msg, "liveness_failed": True}}
+
+    # 2. Detect & Align
+    aligned_face, bbox = get_face_detector().align_face_with_bbox(bgr)
+    if aligned_face is None:
+        return {"failure": {"success": False, "message": "No face detected"}}
+
+    # 3. Extract Embedding (dùng lại embedding nếu crop gần giống frame trước của cùng client)
+    recognizer = get_recognizer()
+    frame_hash, target_embedding = recognizer.recent_embedding(aligned_face, client_key, bbox)
+    if target_embedding is None:
+        target_embedding = get_embedding_streamer().predict([aligned_face])[0]
         if target_embedding is None:
-             return jsonify({"success": False, "message": "Could not extract features"})
-
-        # 4. Compare with DB
-        db_embeddings = db.get_all_embeddings() # {emp_id: vector}
-        # Threshold updated: 0.40 is safe for ArcFace with aligned faces.
-        # Previous 0.15 was too strict (workaround for unaligned faces).
-        # NOTE: You MUST re-enroll employees for this to work effectively!
-        best_id, min_dist = recognizer.find_best_match(target_embedding, db_embeddings, threshold=0.40)
+            return {"failure": {"success": False, "message": "Could not extract features"}}
+        recognizer.remember_frame(client_key, frame_hash, bbox, target_embedding)
+
+    # 4. Compare with DB
+    emp_ids, emb_matrix = db.get_embedding_matrix() # cached (N,), (N, D) normalized
+    best_id, best_sim = recognizer.find_best_match_matrix(
+        target_embedding, emp_ids, emb_matrix, threshold=RECOGNITION_THRESHOLD
+    )
+    return {"best_id": best_id, "best_sim": best_sim, "liveness": liveness_msg}
+
+def _recognize_frame(bgr: Optional[np.ndarray], client_key: Optional[str] = None):
+    """Chạy pipeline nhận diện trên 1 frame BGR đã decode và trả về response."""
+    try:
+        # 1-4. AI inference trên worker pool riêng (tách khỏi thread HTTP)
+        result = _model_executor.submit(_run_pipeline, bgr, client_key).result()
+        if "failure" in result:
+            return jsonify(result["failure"])
+        best_id, best_sim = result["best_id"], result["best_sim"]
         
         # DEBUG: Log recognition results
-        logger.info(f"Recognition result: best_id={best_id}, distance={min_dist:.4f}, threshold=0.40")
-        if best_id:
-            emp = db.get_employee_by_id(best_id)
-            logger.info(f"✓ Matched to: {emp.get('name')} (ID: {best_id})")
-        else:
-            logger.info(f"✗ No match found (distance {min_dist:.4f} > threshold 0.40)")
-        
-        # Convert distance to score (0 -> 1) cho frontend dễ hiển thị
-        # Distance càng nhỏ càng tốt (0 là giống hệt)
-        # Score = 1 - distance (gần đúng)
-        score = 1.0 - min_dist
+        logger.info(f"Recognition result: best_id={best_id}, similarity={best_sim:.4f}, threshold={RECOGNITION_THRESHOLD}")
+        if best_id is None:
+            logger.info(f"✗ No match found (similarity {best_sim:.4f} <= threshold {RECOGNITION_THRESHOLD})")
         
-        # 5. Handle Result
-        info = _handle_attendance(best_id, score)
+        # 5. Handle Result (score = similarity, 1.0 là giống hệt)
+        info = _handle_attendance(best_id, best_sim)
         info["success"] = True
-        info["liveness"] = liveness_msg
+        info["liveness"] = result["liveness"]
         
         return jsonify(info)
 
@@ -337,7 +509,7 @@ def api_recognize_webcam():
 @app.route("/api/history_sessions", methods=["GET"])
 def api_history_sessions():
     limit_days = int(request.args.get("limit_days", 7))
-    sessions = get_daily_sessions(limit_days=limit_days)
+    sessions = db.get_daily_sessions(limit_days=limit_days)
     return jsonify({"success": True, "data": sessions})
 
 
@@ -3,6 +3,7 @@
 import os
 import sqlite3
 import json
+import threading
 import numpy as np
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
@@ -19,17 +20,105 @@ DB_PATH = os.path.join(BASE_DIR, "data", "attendance.db")
 # Configuration
 MIN_CHECKIN_GAP_MINUTES = 1  # Minimum time gap giữa 2 lần chấm công liên tiếp
 
-
-def get_connection():
-    """Tạo connection đến SQLite database."""
+# Cache ma trận embedding (dùng chung trong process).
+# version tăng mỗi khi dữ liệu khuôn mặt thay đổi -> lần đọc tiếp theo sẽ build lại.
+# signature = (COUNT, MAX(id)) của bảng embeddings, để phát hiện thay đổi từ worker khác.
+_EMB_CACHE = {"version": 0, "built_version": -1, "signature": None, "ids": None, "mat": None}
+_EMB_CACHE_LOCK = threading.Lock()
+
+# SQL cho các query trên đường nhận diện / chấm công (dùng chung text để
+# sqlite3 tái sử dụng prepared statement từ cache của connection)
+_SQL_EMPLOYEE_BY_ID = "SELECT * FROM employees WHERE id = ?"
+_SQL_ACTIVE_SHIFT = "SELECT * FROM shifts WHERE employee_id = ? AND day_of_week = ?"
+_SQL_LAST_ATTENDANCE = (
+    "SELECT * FROM attendance_log WHERE employee_id = ? AND is_unknown = 0 "
+    "ORDER BY timestamp DESC LIMIT 1"
+)
+_SQL_INSERT_ATTENDANCE = (
+    "INSERT INTO attendance_log "
+    "(employee_id, code, name, check_type, score, is_unknown, timestamp, late_minutes, shift_id) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+_SQL_EMBEDDING_SIGNATURE = "SELECT COUNT(*), MAX(id) FROM embeddings"
+
+# Connection SQLite theo từng thread (Flask xử lý mỗi request trên 1 thread)
+_local = threading.local()
+# Mọi connection đang cache {thread: conn}, để đóng khi thread kết thúc / tắt app
+_conns = {}
+_conns_lock = threading.Lock()
+# Connection kế thừa từ process cha sau fork: giữ reference, không dùng, không đóng
+_fork_orphans = []
+
+
+def get_connection(check_same_thread: bool = True):
+    """Tạo connection mới đến SQLite database."""
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH, timeout=10.0)
+    conn = sqlite3.connect(
+        DB_PATH, timeout=10.0, cached_statements=256, check_same_thread=check_same_thread
+    )
     conn.row_factory = sqlite3.Row
     # Enable foreign keys
     conn.execute("PRAGMA foreign_keys = ON")
+    # WAL: ghi không block đọc; synchronous=NORMAL: 1 fsync mỗi commit (an toàn với WAL)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")  # 256MB
     return conn
 
 
+def _get_conn():
+    """Lấy connection của thread hiện tại (tạo 1 lần, dùng lại cho các lần gọi sau)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        # check_same_thread=False chỉ để close_all_connections() đóng được từ thread khác;
+        # connection vẫn chỉ được dùng bởi thread sở hữu
+        conn = get_connection(check_same_thread=False)
+        _local.conn = conn
+        with _conns_lock:
+            # Đóng connection của các thread đã kết thúc
+            for thread in [t for t in _conns if not t.is_alive()]:
+                _conns.pop(thread).close()
+            _conns[threading.current_thread()] = conn
+    return conn
+
+
+def close_connection():
+    """Đóng connection của thread hiện tại."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        with _conns_lock:
+            _conns.pop(threading.current_thread(), None)
+        conn.close()
+        _local.conn = None
+
+
+def close_all_connections():
+    """Đóng connection của mọi thread (gọi khi tắt app)."""
+    with _conns_lock:
+        conns = list(_conns.values())
+        _conns.clear()
+    for conn in conns:
+        conn.close()
+    _local.conn = None
+
+
+def _reset_after_fork():
+    """
+    SQLite không cho dùng connection qua fork(): process con bỏ các connection
+    kế thừa (không đóng, tránh ảnh hưởng lock của process cha) và tạo mới khi cần.
+    """
+    global _local, _conns_lock
+    _fork_orphans.extend(_conns.values())
+    _conns.clear()
+    _local = threading.local()
+    _conns_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 @contextmanager
 def get_db_connection():
     """
@@ -41,101 +130,253 @@ def get_db_connection():
             cursor.execute(...)
             conn.commit()  # Auto commit nếu không có exception
     """
-    conn = get_connection()
+    conn = _get_conn()
     try:
         yield conn
         conn.commit()
     except Exception:
         conn.rollback()
         raise
-    finally:
-        conn.close()
 
 
 def init_db():
-    """Khởi tạo database với các bảng cần thiết và indexes."""
-    with get_db_connection() as conn:
+    """
+    Khởi tạo database với các bảng cần thiết và indexes.
+    Schema version lưu trong PRAGMA user_version: DB đã ở version mới nhất
+    thì chỉ tốn 1 câu PRAGMA, không chạy lại DDL.
+    
+    Migration chạy trong 1 transaction BEGIN IMMEDIATE (DDL + user_version
+    commit cùng lúc): nhiều worker gunicorn cùng khởi động thì chỉ 1 process
+    migrate, các process khác chờ lock rồi thấy version đã mới nhất.
+    """
+    conn = get_connection()
+    conn.isolation_level = None  # tự quản lý transaction
+    try:
         cursor = conn.cursor()
+        if cursor.execute("PRAGMA user_version").fetchone()[0] < len(_MIGRATIONS):
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Đọc lại sau khi giữ lock ghi: process khác có thể vừa migrate xong
+                version = cursor.execute("PRAGMA user_version").fetchone()[0]
+                for target, migrate in enumerate(_MIGRATIONS[version:], start=version + 1):
+                    migrate(cursor)
+                    cursor.execute(f"PRAGMA user_version = {target}")
+                    logger.info(f"Database schema migrated to version {target}")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
 
-        # Bảng employees
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS employees (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                gender TEXT,
-                active INTEGER DEFAULT 1,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+    logger.info(f"Database initialized at: {DB_PATH}")
 
-        # Bảng face_images (lưu đường dẫn ảnh khuôn mặt của nhân viên)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS face_images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                employee_id INTEGER NOT NULL,
-                image_path TEXT NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE
-            )
-        """)
 
-        # Bảng attendance_log (lịch sử chấm công)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS attendance_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                employee_id INTEGER,
-                code TEXT,
-                name TEXT,
-                check_type TEXT NOT NULL,
-                score REAL,
-                is_unknown INTEGER DEFAULT 0,
-                timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE SET NULL
-            )
-        """)
+def _migrate_v1(cursor):
+    """Schema ban đầu (idempotent, chạy được cả trên DB cũ chưa có user_version)."""
+    # Bảng employees
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS employees (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            gender TEXT,
+            active INTEGER DEFAULT 1,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Bảng face_images (lưu đường dẫn ảnh khuôn mặt của nhân viên)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS face_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            employee_id INTEGER NOT NULL,
+            image_path TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE
+        )
+    """)
+
+    # Bảng attendance_log (lịch sử chấm công)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            employee_id INTEGER,
+            code TEXT,
+            name TEXT,
+            check_type TEXT NOT NULL,
+            score REAL,
+            is_unknown INTEGER DEFAULT 0,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE SET NULL
+        )
+    """)
+
+    # Bảng embeddings (lưu vector khuôn mặt)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embeddings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            employee_id INTEGER NOT NULL,
+            vector BLOB NOT NULL, -- float32 raw bytes
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE
+        )
+    """)
+    
+    # Bảng employee_embedding (embedding trung bình của mỗi nhân viên, cập nhật khi enroll)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS employee_embedding (
+            employee_id INTEGER PRIMARY KEY,
+            vector BLOB NOT NULL, -- float32 raw bytes, trung bình các embedding
+            count INTEGER NOT NULL,
+            FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE
+        )
+    """)
+    
+    # Bảng shifts (ca làm việc)
+    # day_of_week: 0=Monday, 6=Sunday
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS shifts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            employee_id INTEGER NOT NULL,
+            day_of_week INTEGER NOT NULL,
+            start_time TEXT NOT NULL, -- HH:MM
+            end_time TEXT NOT NULL,   -- HH:MM
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE
+        )
+    """)
 
-        # Bảng embeddings (lưu vector khuôn mặt)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS embeddings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                employee_id INTEGER NOT NULL,
-                vector TEXT NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE
-            )
-        """)
+    # Cập nhật bảng attendance_log để thêm cột late_minutes nếu chưa có
+    try:
+        cursor.execute("ALTER TABLE attendance_log ADD COLUMN late_minutes REAL DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass # Cột đã tồn tại
         
-        # Bảng shifts (ca làm việc)
-        # day_of_week: 0=Monday, 6=Sunday
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS shifts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                employee_id INTEGER NOT NULL,
-                day_of_week INTEGER NOT NULL,
-                start_time TEXT NOT NULL, -- HH:MM
-                end_time TEXT NOT NULL,   -- HH:MM
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE
-            )
-        """)
-
-        # Cập nhật bảng attendance_log để thêm cột late_minutes nếu chưa có
-        try:
-            cursor.execute("ALTER TABLE attendance_log ADD COLUMN late_minutes REAL DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass # Cột đã tồn tại
-            
-        try:
-            cursor.execute("ALTER TABLE attendance_log ADD COLUMN shift_id INTEGER")
-        except sqlite3.OperationalError:
-            pass
-
-        # Tạo indexes
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_shifts_employee ON shifts(employee_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_shifts_day ON shifts(day_of_week)")
-
-    logger.info(f"Database initialized at: {DB_PATH}")
+    try:
+        cursor.execute("ALTER TABLE attendance_log ADD COLUMN shift_id INTEGER")
+    except sqlite3.OperationalError:
+        pass
+
+    # Chuyển embeddings.vector từ JSON text sang BLOB float32 (DB cũ)
+    _migrate_embeddings_to_blob(cursor)
+    _backfill_employee_embedding(cursor)
+
+    # Tạo indexes
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_shifts_employee ON shifts(employee_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_shifts_day ON shifts(day_of_week)")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_attlog_emp_ts "
+        "ON attendance_log(employee_id, is_unknown, timestamp DESC)"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attlog_ts ON attendance_log(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emb_emp ON embeddings(employee_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_faceimg_emp ON face_images(employee_id)")
+
+
+def _migrate_v2(cursor):
+    """L2-normalize các embedding đã lưu và tính lại embedding trung bình."""
+    cursor.execute("SELECT id, vector FROM embeddings")
+    updates = [
+        (_vector_to_blob(_l2_normalize(np.frombuffer(row['vector'], dtype=np.float32))), row['id'])
+        for row in cursor.fetchall()
+    ]
+    cursor.executemany("UPDATE embeddings SET vector = ? WHERE id = ?", updates)
+    cursor.execute("DELETE FROM employee_embedding")
+    _backfill_employee_embedding(cursor)
+
+
+# Danh sách migration theo thứ tự; migration thứ i đưa DB lên user_version = i + 1
+_MIGRATIONS = [_migrate_v1, _migrate_v2]
+
+
+def _migrate_embeddings_to_blob(cursor):
+    """Migrate bảng embeddings cũ (vector TEXT JSON) sang vector BLOB float32."""
+    cursor.execute("PRAGMA table_info(embeddings)")
+    columns = {row['name']: row['type'].upper() for row in cursor.fetchall()}
+    if columns.get('vector') != 'TEXT':
+        return
+
+    # SAVEPOINT: tạo bảng + copy + đổi tên thành 1 khối, lỗi giữa chừng (vd. vector
+    # JSON hỏng) thì rollback cả bảng embeddings_v2, lần khởi động sau chạy lại được
+    cursor.execute("SAVEPOINT migrate_embeddings")
+    try:
+        _copy_embeddings_to_blob(cursor)
+    except Exception:
+        cursor.execute("ROLLBACK TO migrate_embeddings")
+        cursor.execute("RELEASE migrate_embeddings")
+        raise
+    cursor.execute("RELEASE migrate_embeddings")
+
+
+def _copy_embeddings_to_blob(cursor):
+    """Copy bảng embeddings (JSON) sang embeddings_v2 (BLOB) rồi thay thế bảng cũ."""
+    # Bảng sót lại từ lần migrate lỗi trước (trước khi có SAVEPOINT)
+    cursor.execute("DROP TABLE IF EXISTS embeddings_v2")
+    cursor.execute("""
+        CREATE TABLE embeddings_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            employee_id INTEGER NOT NULL,
+            vector BLOB NOT NULL, -- float32 raw bytes
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (employee_id) REFERENCES employees(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("SELECT id, employee_id, vector, created_at FROM embeddings")
+    rows = [
+        (row['id'], row['employee_id'], _vector_to_blob(json.loads(row['vector'])), row['created_at'])
+        for row in cursor.fetchall()
+    ]
+    cursor.executemany(
+        "INSERT INTO embeddings_v2 (id, employee_id, vector, created_at) VALUES (?, ?, ?, ?)",
+        rows
+    )
+    cursor.execute("DROP TABLE embeddings")
+    cursor.execute("ALTER TABLE embeddings_v2 RENAME TO embeddings")
+    logger.info(f"Migrated {len(rows)} embeddings from JSON text to float32 BLOB")
+
+
+def _l2_normalize(vector: np.ndarray) -> np.ndarray:
+    """Chuẩn hóa vector về độ dài 1 (giữ nguyên nếu là vector 0)."""
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _vector_to_blob(vector) -> sqlite3.Binary:
+    """Chuyển vector sang bytes float32 để lưu vào cột BLOB."""
+    return sqlite3.Binary(np.ascontiguousarray(vector, dtype=np.float32).tobytes())
+
+
+def _backfill_employee_embedding(cursor):
+    """Tính bảng employee_embedding từ bảng embeddings (DB cũ chưa có bảng này)."""
+    cursor.execute("SELECT COUNT(*) FROM employee_embedding")
+    if cursor.fetchone()[0] > 0:
+        return
+    cursor.execute("SELECT employee_id, vector FROM embeddings")
+    rows = cursor.fetchall()
+    if not rows:
+        return
+
+    dim = len(rows[0]['vector']) // 4
+    rows = [row for row in rows if len(row['vector']) // 4 == dim]
+    row_ids = np.fromiter((row['employee_id'] for row in rows), dtype=np.int64, count=len(rows))
+    vectors = np.empty((len(rows), dim), dtype=np.float32)
+    for n, row in enumerate(rows):
+        vectors[n] = np.frombuffer(row['vector'], dtype=np.float32)
+
+    # Trung bình embedding theo nhân viên (vectorized, không loop Python)
+    emp_ids, inverse = np.unique(row_ids, return_inverse=True)
+    means = np.zeros((len(emp_ids), dim), dtype=np.float32)
+    np.add.at(means, inverse, vectors)
+    counts = np.bincount(inverse, minlength=len(emp_ids))
+    means /= counts[:, None].astype(np.float32)
+
+    cursor.executemany(
+        "INSERT INTO employee_embedding (employee_id, vector, count) VALUES (?, ?, ?)",
+        [(int(emp_id), _vector_to_blob(mean), int(count))
+         for emp_id, mean, count in zip(emp_ids, means, counts)]
+    )
+    logger.info(f"Backfilled mean embeddings for {len(emp_ids)} employees")
 
 
 def create_employee(code: str, name: str, gender: Optional[str] = None) -> int:
@@ -153,14 +394,11 @@ def create_employee(code: str, name: str, gender: Optional[str] = None) -> int:
 
 def get_employee_by_id(employee_id: int) -> Optional[Dict[str, Any]]:
     """Lấy thông tin nhân viên theo ID."""
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM employees WHERE id = ?", (employee_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute(_SQL_EMPLOYEE_BY_ID, (employee_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
 
 
 def delete_employee_permanently(employee_id: int):
@@ -173,6 +411,7 @@ def delete_employee_permanently(employee_id: int):
         
         # Delete embeddings
         cursor.execute("DELETE FROM embeddings WHERE employee_id = ?", (employee_id,))
+        cursor.execute("DELETE FROM employee_embedding WHERE employee_id = ?", (employee_id,))
         
         # Delete attendance logs (optional, clean up)
         cursor.execute("DELETE FROM attendance_log WHERE employee_id = ?", (employee_id,))
@@ -184,18 +423,16 @@ def delete_employee_permanently(employee_id: int):
         cursor.execute("DELETE FROM employees WHERE id = ?", (employee_id,))
         
         logger.info(f"Permanently deleted employee ID: {employee_id} and all related data")
+    _bump_version()
 
 
 def list_employees(active_only: bool = True) -> List[Dict[str, Any]]:
     """Lấy danh sách nhân viên."""
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM employees ORDER BY code")
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
-    finally:
-        conn.close()
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM employees ORDER BY code")
+    rows = cursor.fetchall()
+    return [dict(row) for row in rows]
 
 
 # --- SHIFT MANAGEMENT ---
@@ -217,37 +454,31 @@ def assign_shift(employee_id: int, day_of_week: int, start_time: str, end_time:
 
 def get_shifts_for_employee(employee_id: int) -> List[Dict[str, Any]]:
     """Lấy danh sách ca làm của nhân viên."""
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM shifts WHERE employee_id = ? ORDER BY day_of_week",
-            (employee_id,)
-        )
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
-    finally:
-        conn.close()
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT * FROM shifts WHERE employee_id = ? ORDER BY day_of_week",
+        (employee_id,)
+    )
+    rows = cursor.fetchall()
+    return [dict(row) for row in rows]
 
 def get_active_shift(employee_id: int, check_time: datetime) -> Optional[Dict[str, Any]]:
     """Tìm ca làm việc khớp với thời gian hiện tại (hoặc gần nhất trong ngày)."""
     day_of_week = check_time.weekday() # 0=Mon, 6=Sun
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM shifts WHERE employee_id = ? AND day_of_week = ?",
-            (employee_id, day_of_week)
-        )
-        # Giả sử mỗi ngày 1 ca, nếu nhiều ca cần logic phức tạp hơn
-        row = cursor.fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute(_SQL_ACTIVE_SHIFT, (employee_id, day_of_week))
+    # Giả sử mỗi ngày 1 ca, nếu nhiều ca cần logic phức tạp hơn
+    row = cursor.fetchone()
+    return dict(row) if row else None
 
 
 # --- ATTENDANCE LOGGING ---
 
+# Sentinel: caller chưa query bản ghi chấm công gần nhất
+_NOT_FETCHED = object()
+
 def log_attendance_event(
     employee_id: Optional[int],
     code: Optional[str],
@@ -256,13 +487,21 @@ def log_attendance_event(
     score: float,
     is_unknown: bool = False,
     validate_timing: bool = True,
-):
+    last_record: Any = _NOT_FETCHED,
+) -> float:
     """
     Ghi log chấm công có tính toán trễ giờ.
+    
+    Args:
+        last_record: Bản ghi chấm công gần nhất nếu caller đã query
+                     (None = chưa có bản ghi nào), để khỏi query lại.
+    
+    Returns:
+        Số phút đi trễ (0 nếu đúng giờ / OUT / Unknown)
     """
     # Validate timing (30s gap)
     if not is_unknown and employee_id and validate_timing:
-        validate_attendance_timing(employee_id)
+        validate_attendance_timing(employee_id, last_record=last_record)
     
     late_minutes = 0.0
     shift_id = None
@@ -287,9 +526,7 @@ def log_attendance_event(
         cursor = conn.cursor()
         timestamp = datetime.now().isoformat()
         cursor.execute(
-            """INSERT INTO attendance_log 
-               (employee_id, code, name, check_type, score, is_unknown, timestamp, late_minutes, shift_id)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            _SQL_INSERT_ATTENDANCE,
             (employee_id, code, name, check_type, score, 1 if is_unknown else 0, timestamp, late_minutes, shift_id)
         )
         
@@ -298,11 +535,13 @@ def log_attendance_event(
             logger.warning(f"Unknown attendance logged")
         else:
             logger.info(f"Attendance: {name} ({check_type}) - {status_msg}")
+    return late_minutes
 
 
-def validate_attendance_timing(employee_id: int) -> None:
+def validate_attendance_timing(employee_id: int, last_record: Any = _NOT_FETCHED) -> None:
     """Validate thời gian chấm công (30s gap)."""
-    last_record = get_last_attendance_for_employee(employee_id)
+    if last_record is _NOT_FETCHED:
+        last_record = get_last_attendance_for_employee(employee_id)
     if last_record:
         last_time = datetime.fromisoformat(last_record['timestamp'])
         now = datetime.now()
@@ -317,66 +556,54 @@ def validate_attendance_timing(employee_id: int) -> None:
 
 def get_attendance_history(employee_id: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
     """Lấy lịch sử chấm công, filter theo nhân viên (loại trừ Unknown)."""
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        if employee_id:
-            cursor.execute("""
-                SELECT * FROM attendance_log 
-                WHERE employee_id = ? AND is_unknown = 0
-                ORDER BY timestamp DESC LIMIT ?
-            """, (employee_id, limit))
-        else:
-            # Exclude unknown entries from general history
-            cursor.execute("""
-                SELECT * FROM attendance_log 
-                WHERE is_unknown = 0
-                ORDER BY timestamp DESC LIMIT ?
-            """, (limit,))
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
-    finally:
-        conn.close()
+    conn = _get_conn()
+    cursor = conn.cursor()
+    if employee_id:
+        cursor.execute("""
+            SELECT * FROM attendance_log 
+            WHERE employee_id = ? AND is_unknown = 0
+            ORDER BY timestamp DESC LIMIT ?
+        """, (employee_id, limit))
+    else:
+        # Exclude unknown entries from general history
+        cursor.execute("""
+            SELECT * FROM attendance_log 
+            WHERE is_unknown = 0
+            ORDER BY timestamp DESC LIMIT ?
+        """, (limit,))
+    rows = cursor.fetchall()
+    return [dict(row) for row in rows]
 
 
 
 def get_last_attendance_for_employee(employee_id: int) -> Optional[Dict[str, Any]]:
     """Lấy bản ghi chấm công gần nhất của nhân viên."""
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(
-            """SELECT * FROM attendance_log 
-               WHERE employee_id = ? AND is_unknown = 0
-               ORDER BY timestamp DESC LIMIT 1""",
-            (employee_id,)
-        )
-        row = cursor.fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute(_SQL_LAST_ATTENDANCE, (employee_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
 
 
 def get_daily_sessions(limit_days: int = 7) -> List[Dict[str, Any]]:
     """Lấy lịch sử chấm công theo ngày (group by ngày)."""
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                DATE(timestamp) as date,
-                COUNT(*) as total_checks,
-                SUM(CASE WHEN is_unknown = 0 THEN 1 ELSE 0 END) as known_checks,
-                SUM(CASE WHEN is_unknown = 1 THEN 1 ELSE 0 END) as unknown_checks
-            FROM attendance_log
-            WHERE DATE(timestamp) >= DATE('now', '-' || ? || ' days')
-            GROUP BY DATE(timestamp)
-            ORDER BY date DESC
-        """, (limit_days,))
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
-    finally:
-        conn.close()
+    # So sánh trực tiếp cột timestamp (ISO, prefix YYYY-MM-DD) để dùng được idx_attlog_ts
+    since = (datetime.now() - timedelta(days=limit_days)).strftime('%Y-%m-%d')
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT 
+            DATE(timestamp) as date,
+            COUNT(*) as total_checks,
+            SUM(CASE WHEN is_unknown = 0 THEN 1 ELSE 0 END) as known_checks,
+            SUM(CASE WHEN is_unknown = 1 THEN 1 ELSE 0 END) as unknown_checks
+        FROM attendance_log
+        WHERE timestamp >= ?
+        GROUP BY DATE(timestamp)
+        ORDER BY date DESC
+    """, (since,))
+    rows = cursor.fetchall()
+    return [dict(row) for row in rows]
 
 
 # --- EXTENDED FUNCTIONS ---
@@ -390,57 +617,115 @@ def add_face_image(employee_id: int, image_path: str):
             (employee_id, image_path)
         )
         logger.debug(f"Added face image for employee {employee_id}: {image_path}")
+    _bump_version()
 
 
 def save_embedding(employee_id: int, vector):
-    """Lưu vector embedding vào database."""
-    vector_json = json.dumps(vector.tolist() if hasattr(vector, 'tolist') else vector)
+    """
+    Lưu vector embedding vào database (BLOB float32) và cập nhật embedding trung bình.
+    Vector được L2-normalize trước khi lưu để mỗi lần enroll có trọng số như nhau.
+    """
+    vector = _l2_normalize(np.asarray(vector, dtype=np.float32))
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO embeddings (employee_id, vector) VALUES (?, ?)",
-            (employee_id, vector_json)
+            (employee_id, _vector_to_blob(vector))
+        )
+
+        # Running mean: new = (old * count + v) / (count + 1)
+        cursor.execute(
+            "SELECT vector, count FROM employee_embedding WHERE employee_id = ?",
+            (employee_id,)
         )
-        logger.debug(f"Saved embedding for employee {employee_id}")
+        row = cursor.fetchone()
+        if row and len(row['vector']) == vector.nbytes:
+            count = row['count']
+            old = np.frombuffer(row['vector'], dtype=np.float32)
+            mean = (old * count + vector) / (count + 1)
+        else:
+            count, mean = 0, vector
+        cursor.execute(
+            """INSERT INTO employee_embedding (employee_id, vector, count) VALUES (?, ?, ?)
+               ON CONFLICT(employee_id) DO UPDATE SET vector = excluded.vector, count = excluded.count""",
+            (employee_id, _vector_to_blob(mean), count + 1)
+        )
+        logger.debug(f"Saved embedding for employee {employee_id} ({count + 1} total)")
+    _bump_version()
+
 
+def _bump_version():
+    """Đánh dấu cache embedding đã cũ (gọi sau mỗi thay đổi dữ liệu khuôn mặt)."""
+    with _EMB_CACHE_LOCK:
+        _EMB_CACHE["version"] += 1
 
-def get_all_embeddings() -> Dict[int, List[float]]:
+
+def _load_embedding_matrix(cursor):
+    """
+    Đọc embedding trung bình của các nhân viên đang active (bảng employee_embedding).
+    Returns: (emp_ids: int64 (N,), mat: float32 (N, D)) đã L2-normalize từng dòng.
     """
-    Lấy tất cả embedding của nhân viên.
+    cursor.execute("""
+        SELECT ee.employee_id, ee.vector
+        FROM employee_embedding ee
+        JOIN employees e ON ee.employee_id = e.id
+        WHERE e.active = 1
+        ORDER BY ee.employee_id
+    """)
+    rows = cursor.fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+    dim = len(rows[0]['vector']) // 4
+    emp_ids = np.empty(len(rows), dtype=np.int64)
+    mat = np.empty((len(rows), dim), dtype=np.float32)
+    n = 0
+    for row in rows:
+        vector = np.frombuffer(row['vector'], dtype=np.float32)
+        if len(vector) != dim:
+            logger.warning(f"Skip embedding of employee {row['employee_id']}: dim {len(vector)} != {dim}")
+            continue
+        emp_ids[n] = row['employee_id']
+        mat[n] = vector
+        n += 1
+    emp_ids, mat = emp_ids[:n], mat[:n]
+
+    # L2-normalize để so khớp chỉ còn là 1 phép nhân ma trận (mat @ q)
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    mat /= norms
+    return emp_ids, mat
+
+
+def get_embedding_matrix():
+    """
+    Lấy ma trận embedding (có cache).
+    Returns: (emp_ids, mat) - emp_ids: np.ndarray int64 (N,), mat: np.ndarray float32 (N, D),
+             mỗi dòng của mat đã được L2-normalize.
+    """
+    conn = _get_conn()
+    cursor = conn.cursor()
+    cursor.execute(_SQL_EMBEDDING_SIGNATURE)
+    signature = tuple(cursor.fetchone())
+
+    with _EMB_CACHE_LOCK:
+        version = _EMB_CACHE["version"]
+        if (_EMB_CACHE["built_version"] == version
+                and _EMB_CACHE["signature"] == signature):
+            return _EMB_CACHE["ids"], _EMB_CACHE["mat"]
+
+    emp_ids, mat = _load_embedding_matrix(cursor)
+
+    with _EMB_CACHE_LOCK:
+        _EMB_CACHE.update(built_version=version, signature=signature, ids=emp_ids, mat=mat)
+    logger.debug(f"Embedding cache rebuilt: {len(emp_ids)} employees")
+    return emp_ids, mat
+
+
+def get_all_embeddings() -> Dict[int, np.ndarray]:
+    """
+    Lấy embedding (trung bình, đã normalize) của từng nhân viên.
     Returns: {employee_id: vector}
     """
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT e.id, emb.vector
-            FROM embeddings emb
-            JOIN employees e ON emb.employee_id = e.id
-            WHERE e.active = 1
-            ORDER BY emb.created_at DESC
-        """)
-        rows = cursor.fetchall()
-        
-        # Collect ALL embeddings for each employee
-        employee_embeddings = {}  # {emp_id: [vector1, vector2, ...]}
-        for row in rows:
-            emp_id = row['id']
-            vector = json.loads(row['vector'])
-            if emp_id not in employee_embeddings:
-                employee_embeddings[emp_id] = []
-            employee_embeddings[emp_id].append(vector)
-        
-        # Average embeddings for each employee (better accuracy)
-        embeddings = {}
-        for emp_id, vectors in employee_embeddings.items():
-            if len(vectors) == 1:
-                embeddings[emp_id] = vectors[0]
-            else:
-                # Average multiple embeddings
-                avg_vector = np.mean(np.array(vectors), axis=0).tolist()
-                embeddings[emp_id] = avg_vector
-                logger.debug(f"Employee {emp_id}: averaged {len(vectors)} embeddings")
-        
-        return embeddings
-    finally:
-        conn.close()
+    emp_ids, mat = get_embedding_matrix()
+    return {int(emp_id): vector for emp_id, vector in zip(emp_ids, mat)}
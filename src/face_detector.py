@@ -1,7 +1,17 @@
+import os
 import cv2
 import numpy as np
 from deepface import DeepFace
 from typing import Tuple, Optional, List, Dict, Any
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Haar cascade đi kèm project (data/haarcascades), fallback về bản của OpenCV
+HAAR_CASCADE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "data", "haarcascades", "haarcascade_frontalface_default.xml"
+)
 
 class FaceDetector:
     """
@@ -15,7 +25,32 @@ class FaceDetector:
             backend: "opencv", "ssd", "dlib", "mtcnn", "retinaface", "yolov8"
         """
         self.backend = backend
+        self._cascade = None
+        if backend == "opencv":
+            # Gọi thẳng Haar cascade: chỉ cần bbox nên bỏ qua bước crop/normalize
+            # float của DeepFace.extract_faces
+            path = HAAR_CASCADE_PATH
+            if not os.path.exists(path):
+                path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+            cascade = cv2.CascadeClassifier(path)
+            if not cascade.empty():
+                self._cascade = cascade
         
+    def _detect_haar(self, image: np.ndarray) -> List[Dict[str, Any]]:
+        """Detect bằng Haar cascade (cùng tham số với backend opencv của DeepFace)."""
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        boxes, _, weights = self._cascade.detectMultiScale3(
+            gray, scaleFactor=1.1, minNeighbors=10, outputRejectLevels=True
+        )
+        return [
+            {
+                'bbox': (int(x), int(y), int(w), int(h)),
+                'score': float(score),
+                'keypoints': {}
+            }
+            for (x, y, w, h), score in zip(boxes, np.ravel(weights))
+        ]
+
     def detect_faces(self, image: np.ndarray) -> List[Dict[str, Any]]:
         """
         Phát hiện khuôn mặt trong ảnh.
@@ -24,6 +59,9 @@ class FaceDetector:
             return []
             
         try:
+            if self._cascade is not None:
+                return self._detect_haar(image)
+
             # DeepFace.extract_faces trả về list các dict
             # enforce_detection=False để không crash nếu không thấy mặt
             results = DeepFace.extract_faces(
@@ -52,9 +90,9 @@ class FaceDetector:
         if not faces:
             return None
         
-        # Sắp xếp theo diện tích (w * h) giảm dần
-        largest = max(faces, key=lambda f: f['bbox'][2] * f['bbox'][3])
-        return largest
+        # Chọn mặt có diện tích (w * h) lớn nhất: 1 lần argmax thay vì lambda cho từng phần tử
+        areas = np.fromiter((f['bbox'][2] * f['bbox'][3] for f in faces), dtype=np.int64, count=len(faces))
+        return faces[int(areas.argmax())]
 
     def extract_face(
         self, 
@@ -71,14 +109,14 @@ class FaceDetector:
             
         x, y, w, h = face['bbox']
         
-        # Thêm padding
+        # Thêm padding rồi clip vào khung ảnh (1 phép np.clip cho cả 4 tọa độ)
         pad_w = int(w * padding)
         pad_h = int(h * padding)
-        
-        x1 = max(0, x - pad_w)
-        y1 = max(0, y - pad_h)
-        x2 = min(image.shape[1], x + w + pad_w)
-        y2 = min(image.shape[0], y + h + pad_h)
+        img_h, img_w = image.shape[:2]
+        x1, y1, x2, y2 = np.clip(
+            [x - pad_w, y - pad_h, x + w + pad_w, y + h + pad_h],
+            0, [img_w, img_h, img_w, img_h]
+        ).tolist()
         
         face_img = image[y1:y2, x1:x2]
         
@@ -88,12 +126,25 @@ class FaceDetector:
         return face_img
 
     def align_face(self, image: np.ndarray) -> Optional[np.ndarray]:
+        """Detect and align face (xem align_face_with_bbox), chỉ trả về ảnh khuôn mặt."""
+        return self.align_face_with_bbox(image)[0]
+
+    def align_face_with_bbox(
+        self, image: np.ndarray
+    ) -> Tuple[Optional[np.ndarray], Optional[Tuple[int, int, int, int]]]:
         """
         Detect and align face using DeepFace.
         Returns the aligned face image (RGB/BGR depending on DeepFace output, usually RGB normalized 0-1 or uint8).
         Note: DeepFace.extract_faces returns normalized float image (0-1) by default. 
         We need to convert it back to uint8 (0-255) for consistency.
+        
+        Chỉ chạy detector 1 lần: không thấy mặt thì trả về None, lỗi sau khi
+        đã detect thì crop từ bbox vừa tìm được thay vì detect lại.
+        
+        Returns:
+            (face_img, bbox (x, y, w, h) trên ảnh gốc); bbox là None nếu không biết
         """
+        largest_face = None
         try:
             # Use DeepFace to extract and align
             results = DeepFace.extract_faces(
@@ -105,7 +156,7 @@ class FaceDetector:
             )
             
             if not results:
-                return None
+                return None, None
 
             # Get the first/largest face
             # DeepFace returns a list of dicts. We take the one with highest confidence or area.
@@ -116,24 +167,29 @@ class FaceDetector:
             
             face_img = largest_face['face']
             
-            # DeepFace returns image in range [0, 1] float. Convert to [0, 255] uint8
+            # DeepFace returns RGB in range [0, 1] float. Convert to BGR [0, 255] uint8
+            # (BGR để nhất quán với pipeline OpenCV của app; DeepFace.represent nhận numpy BGR).
+            # Đảo kênh (view) + scale/cast gộp trong 1 lần convertScaleAbs thay vì 2 lượt.
             if face_img.max() <= 1.0:
-                face_img = (face_img * 255).astype(np.uint8)
-            
-            # DeepFace returns RGB. If our system uses BGR (OpenCV), we might need to swap.
-            # However, DeepFace models expect RGB usually.
-            # But wait, extract_embedding in face_recognizer uses DeepFace.represent which expects path or numpy array.
-            # If we pass numpy array, DeepFace expects BGR by default if it's from cv2.imread?
-            # DeepFace.extract_faces input is expected to be BGR if numpy array.
-            # The output of extract_faces is RGB.
+                face_img = cv2.convertScaleAbs(face_img[:, :, ::-1], alpha=255.0)
+            else:
+                face_img = cv2.cvtColor(face_img, cv2.COLOR_RGB2BGR)
             
-            # Let's convert to BGR to maintain consistency with the rest of the app (OpenCV pipeline)
-            face_img = cv2.cvtColor(face_img, cv2.COLOR_RGB2BGR)
+            area = largest_face['facial_area']
+            return face_img, (area['x'], area['y'], area['w'], area['h'])
             
-            return face_img
-            
-        except Exception as e:
+        except ValueError as e:
+            # enforce_detection=True: DeepFace raise ValueError khi không thấy mặt,
+            # detect lại bằng cùng backend cũng không ra nên trả về None luôn.
+            # ValueError khác (ảnh lỗi, backend cấu hình sai) thì log lại để không bị ẩn.
+            if "could not be detected" not in str(e):
+                logger.warning(f"Face alignment failed ({self.backend}): {e}")
+            return None, None
+        except Exception:
             # Fallback to simple crop if alignment fails
-            # print(f"Alignment failed: {e}")
-            return self.extract_face(image)
+            if largest_face is None:
+                return self.extract_face(image), None
+            area = largest_face['facial_area']
+            x, y = max(0, area['x']), max(0, area['y'])
+            return image[y:y + area['h'], x:x + area['w']], (x, y, area['w'], area['h'])
 
@@ -1,112 +1,617 @@
 import numpy as np
 from deepface import DeepFace
 from typing import List, Dict, Any, Optional, Tuple
+import contextlib
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
 import cv2
 from src.logger import get_logger
 
 logger = get_logger(__name__)
 
+# TensorFlow: chạy model trên GPU nếu có (memory growth để không chiếm hết VRAM),
+# không có GPU / không import được thì chạy CPU như cũ
+try:
+    import tensorflow as tf
+    _gpus = tf.config.list_physical_devices("GPU")
+    for _gpu in _gpus:
+        tf.config.experimental.set_memory_growth(_gpu, True)
+    TF_DEVICE = "/GPU:0" if _gpus else None
+except Exception as e:
+    tf = None
+    TF_DEVICE = None
+    logger.debug(f"TensorFlow GPU setup skipped: {e}")
+
+
+def _device_scope():
+    """Context đặt model lên GPU (nếu có), ngược lại không làm gì."""
+    if TF_DEVICE is None:
+        return contextlib.nullcontext()
+    return tf.device(TF_DEVICE)
+
+# Numba (optional): matcher biên dịch sang mã máy khi không có BLAS
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _cos_match(emb_matrix, q):
+        """Trả về (index, similarity) của dòng có dot product lớn nhất với q."""
+        scores = np.empty(emb_matrix.shape[0], dtype=np.float32)
+        for i in prange(emb_matrix.shape[0]):
+            s = np.float32(0.0)
+            for k in range(emb_matrix.shape[1]):
+                s += emb_matrix[i, k] * q[k]
+            scores[i] = s
+        best = np.argmax(scores)
+        return best, scores[best]
+
+# SimSIMD (optional): kernel cosine AVX-512/NEON, nhanh hơn NumPy cho vector nhỏ
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+# ONNX Runtime (optional): chạy model đã export (models/<model>.onnx), ít overhead hơn Keras
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+ONNX_PROVIDERS = ("TensorrtExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider")
+
+# hnswlib (optional): index ANN cho DB lớn (lọc top-k rồi tính cosine chính xác)
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# xxhash (optional): hash nội dung ảnh nhanh hơn blake2b
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lượng tử hóa từng vector (dòng) sang int8 với scale riêng: v ≈ q * scale,
+    scale = max(|v|) / 127. Trả về (Q int8 (N, D), scales float32 (N,)).
+    """
+    v = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.abs(v).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    q = np.round(v / scales[:, None]).astype(np.int8)
+    return q, scales.astype(np.float32)
+
+
+def onnx_model_path(model_name: str = "ArcFace") -> str:
+    """Đường dẫn file ONNX mặc định của model: models/<model_name>.onnx (chữ thường)."""
+    return os.path.join(MODELS_DIR, f"{model_name.lower()}.onnx")
+
+
+def export_onnx(model_name: str = "ArcFace", output_path: Optional[str] = None, fp16: bool = False) -> str:
+    """
+    Export model Keras của DeepFace sang ONNX (chạy 1 lần, cần tf2onnx;
+    fp16=True cần thêm onnxconverter-common).
+
+    Usage:
+        python -c "from src.face_recognizer import export_onnx; export_onnx()"
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    output_path = output_path or onnx_model_path(model_name)
+    model = DeepFace.build_model(model_name)
+    # DeepFace mới bọc Keras model trong client (.model), bản cũ trả về Keras model
+    keras_model = getattr(model, "model", model)
+    spec = (tf.TensorSpec((None, *keras_model.input_shape[1:]), tf.float32, name="input"),)
+    onnx_model, _ = tf2onnx.convert.from_keras(keras_model, input_signature=spec, opset=15)
+
+    if fp16:
+        from onnxconverter_common import float16
+        onnx_model = float16.convert_float_to_float16(onnx_model, keep_io_types=True)
+
+    import onnx
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    onnx.save(onnx_model, output_path)
+    logger.info(f"Exported {model_name} to {output_path}")
+    return output_path
+
+
+def dhash(image: np.ndarray) -> int:
+    """Perceptual hash 64-bit (dHash): so sánh độ sáng các pixel kề nhau trên ảnh xám 9x8."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _as_embedding(values) -> np.ndarray:
+    """Chuyển output của model sang np.ndarray float32 liên tục (read-only vì được chia sẻ qua cache)."""
+    embedding = np.ascontiguousarray(values, dtype=np.float32).ravel()
+    embedding.setflags(write=False)
+    return embedding
+
+
+def _bbox_iou(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    """IoU của 2 bbox (x, y, w, h)."""
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _image_key(image: np.ndarray) -> Tuple:
+    """Key cache theo nội dung ảnh: (hash 64-bit, shape, dtype)."""
+    data = np.ascontiguousarray(image)
+    if xxhash is not None:
+        digest = xxhash.xxh3_64_intdigest(data)
+    else:
+        digest = hashlib.blake2b(data, digest_size=8).digest()
+    return digest, data.shape, data.dtype.str
+
 class DeepFaceRecognizer:
     """
     Nhận diện khuôn mặt sử dụng DeepFace (ArcFace/FaceNet).
     Thay thế hoàn toàn PCA cũ.
     """
     
-    def __init__(self, model_name="ArcFace", detector_backend="mediapipe"):
+    # Số embedding tối đa giữ trong LRU cache (theo nội dung ảnh)
+    EMBEDDING_CACHE_SIZE = 512
+    # Dùng lại embedding của frame trước (cùng client) khi: dHash lệch tối đa
+    # FRAME_HASH_MAX_DISTANCE bit, bbox trùng IoU >= FRAME_BBOX_MIN_IOU và
+    # frame trước chưa quá FRAME_REUSE_TTL giây
+    FRAME_HASH_MAX_DISTANCE = 5
+    FRAME_BBOX_MIN_IOU = 0.6
+    FRAME_REUSE_TTL = 1.5
+    # Từ số nhân viên này trở lên (đã cài hnswlib, matcher "auto"/"hnsw") thì so
+    # khớp 2 bước qua HNSW; index build ở background, trong lúc chờ vẫn brute force
+    ANN_MIN_SIZE = 5000
+    ANN_TOP_K = 5
+    
+    def __init__(self, model_name="ArcFace", detector_backend="mediapipe", matcher="auto", onnx_path=None):
         """
         Args:
             model_name: "VGG-Face", "Facenet", "Facenet512", "OpenFace", "DeepFace", "DeepID", "ArcFace", "Dlib", "SFace"
             detector_backend: "opencv", "ssd", "dlib", "mtcnn", "retinaface", "mediapipe"
+            matcher: "auto" (SimSIMD nếu đã cài, ngược lại NumPy), "simsimd",
+                     "numpy" (BLAS matmul), "numba" (khi NumPy không có BLAS),
+                     "int8" (ma trận lượng tử hóa int8, đọc ít bộ nhớ hơn 4 lần)
+                     hoặc "hnsw" (index HNSW cho DB lớn, brute force NumPy khi chưa có).
+                     Chỉ "auto" và "hnsw" dùng HNSW.
+            onnx_path: File ONNX của model (mặc định models/<model_name>.onnx, xem export_onnx).
+                       Nếu có file và đã cài onnxruntime thì dùng thay cho DeepFace.represent.
         """
         self.model_name = model_name
         self.detector_backend = detector_backend
+        # HNSW chỉ dùng khi matcher cho phép, không ghi đè lựa chọn tường minh
+        self.use_ann = matcher in ("auto", "hnsw") and hnswlib is not None
+        if matcher == "hnsw":
+            if hnswlib is None:
+                logger.warning("hnswlib not installed, falling back to NumPy matcher.")
+            matcher = "numpy"
+        if matcher == "auto":
+            matcher = "simsimd" if simsimd is not None else "numpy"
+        if matcher == "numba" and njit is None:
+            logger.warning("Numba not installed, falling back to NumPy matcher.")
+            matcher = "numpy"
+        if matcher == "simsimd" and simsimd is None:
+            logger.warning("SimSIMD not installed, falling back to NumPy matcher.")
+            matcher = "numpy"
+        self.matcher = matcher
+        # Cache ma trận int8 của matcher "int8": (ma trận nguồn, Q, scales)
+        self._int8_index = None
+        # Cache index HNSW: (ma trận nguồn, hnswlib.Index); ma trận đang build ở background
+        self._ann_index = None
+        self._ann_building = None
+        self._ann_lock = threading.Lock()
+        # LRU cache embedding: frame giống hệt (retry, frame UI lặp lại) không chạy lại model
+        self._embedding_cache = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()
+        # Crop gần nhất của từng luồng video: {client_key: (time, dHash, bbox, embedding)}
+        self._last_frames = {}
+        # Kích thước input (w, h) của model, dùng để letterbox batch về cùng shape
+        self.input_size = None
+        self._onnx_session = self._load_onnx(onnx_path or onnx_model_path(model_name))
+        if self._onnx_session is not None:
+            return
         # Load model trước để tránh delay lần đầu
-        logger.info(f"Initializing DeepFace model: {model_name}...")
+        logger.info(f"Initializing DeepFace model: {model_name} on {TF_DEVICE or 'CPU'}...")
         try:
-            # Dummy build to load weights
-            DeepFace.build_model(model_name)
+            with _device_scope():
+                model = DeepFace.build_model(model_name)
+            self.input_size = self._model_input_size(model)
             logger.info("DeepFace model loaded successfully.")
         except Exception as e:
             logger.error(f"Failed to load DeepFace model: {e}")
-            
-    def extract_embedding(self, image: np.ndarray) -> Optional[List[float]]:
+
+    def _load_onnx(self, path: str):
+        """Tạo InferenceSession nếu có onnxruntime và file model, ngược lại None."""
+        if ort is None or not os.path.exists(path):
+            return None
+        try:
+            available = ort.get_available_providers()
+            providers = [p for p in ONNX_PROVIDERS if p in available]
+            session = ort.InferenceSession(path, providers=providers)
+            _, h, w, _ = session.get_inputs()[0].shape
+            self.input_size = (int(w), int(h))
+            logger.info(f"Loaded ONNX model {path} ({session.get_providers()[0]})")
+            return session
+        except Exception as e:
+            logger.error(f"Failed to load ONNX model {path}, using DeepFace: {e}")
+            return None
+
+    def _letterbox(self, image: np.ndarray) -> np.ndarray:
+        """
+        Resize giữ tỉ lệ rồi pad 0 (căn giữa) về input size của model, cùng
+        hình học với preprocessing của DeepFace.represent: crop đã đúng size
+        thì DeepFace không resize nữa, embedding giống như khi gọi từng ảnh.
+        """
+        w, h = self.input_size
+        if (image.shape[1], image.shape[0]) == (w, h):
+            return image
+        factor = min(w / image.shape[1], h / image.shape[0])
+        new_w = max(1, int(image.shape[1] * factor))
+        new_h = max(1, int(image.shape[0] * factor))
+        resized = cv2.resize(image, (new_w, new_h))
+        out = np.zeros((h, w, 3), dtype=image.dtype)
+        top, left = (h - new_h) // 2, (w - new_w) // 2
+        out[top:top + new_h, left:left + new_w] = resized
+        return out
+
+    def _onnx_preprocess(self, image: np.ndarray) -> np.ndarray:
+        """Tiền xử lý giống DeepFace.represent: letterbox, BGR -> RGB, scale về [0, 1]."""
+        return self._letterbox(image)[:, :, ::-1].astype(np.float32) * (1.0 / 255.0)
+
+    def _represent_onnx(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """Chạy model ONNX cho cả batch ảnh khuôn mặt (BGR uint8)."""
+        batch = np.stack([self._onnx_preprocess(image) for image in images])
+        input_name = self._onnx_session.get_inputs()[0].name
+        embeddings = self._onnx_session.run(None, {input_name: batch})[0]
+        return [_as_embedding(embedding) for embedding in embeddings]
+
+    @staticmethod
+    def _model_input_size(model) -> Optional[Tuple[int, int]]:
         """
-        Tạo vector embedding từ ảnh khuôn mặt.
+        Lấy kích thước input (w, h) của model: DeepFace mới trả về client có
+        input_shape (h, w), bản cũ trả về Keras model (None, h, w, 3).
         """
+        shape = getattr(model, "input_shape", None)
+        if shape is None:
+            return None
+        if len(shape) == 4:
+            shape = shape[1:3]
+        h, w = int(shape[0]), int(shape[1])
+        return w, h
+
+    def _cache_get(self, key) -> Optional[np.ndarray]:
+        with self._embedding_cache_lock:
+            embedding = self._embedding_cache.get(key)
+            if embedding is not None:
+                self._embedding_cache.move_to_end(key)
+            return embedding
+
+    def _cache_put(self, key, embedding: np.ndarray):
+        with self._embedding_cache_lock:
+            self._embedding_cache[key] = embedding
+            self._embedding_cache.move_to_end(key)
+            if len(self._embedding_cache) > self.EMBEDDING_CACHE_SIZE:
+                self._embedding_cache.popitem(last=False)
+
+    def clear_embedding_cache(self):
+        """Xóa LRU cache embedding (ví dụ khi đổi model)."""
+        with self._embedding_cache_lock:
+            self._embedding_cache.clear()
+            self._last_frames.clear()
+
+    def recent_embedding(
+        self, image: np.ndarray, client_key, bbox: Optional[Tuple[int, int, int, int]]
+    ) -> Tuple[int, Optional[np.ndarray]]:
+        """
+        Dùng cho luồng video: frame liên tiếp của cùng 1 camera gần như giống
+        nhau nên nếu crop hiện tại đủ gần crop trước của client đó (dHash,
+        vị trí bbox, còn trong TTL) thì trả lại embedding cũ, bỏ qua 1 lần forward.
+        Không có bbox hoặc client_key thì không dùng lại.
+        
+        Args:
+            image: Ảnh khuôn mặt đã align
+            client_key: Định danh luồng video (stream_id do client gửi lên), None = không dùng lại
+            bbox: (x, y, w, h) của khuôn mặt trên frame
+        
+        Returns:
+            (frame_hash, embedding hoặc None); frame_hash truyền lại cho remember_frame
+        """
+        frame_hash = dhash(image)
+        if client_key is None:
+            return frame_hash, None
+        with self._embedding_cache_lock:
+            last = self._last_frames.get(client_key)
+        if (
+            last is not None and bbox is not None
+            and time.monotonic() - last[0] <= self.FRAME_REUSE_TTL
+            and bin(frame_hash ^ last[1]).count("1") <= self.FRAME_HASH_MAX_DISTANCE
+            and _bbox_iou(bbox, last[2]) >= self.FRAME_BBOX_MIN_IOU
+        ):
+            return frame_hash, last[3]
+        return frame_hash, None
+
+    def remember_frame(
+        self, client_key, frame_hash: int, bbox: Optional[Tuple[int, int, int, int]], embedding: np.ndarray
+    ):
+        """Lưu embedding của crop vừa tính để frame sau của client dùng lại (xem recent_embedding)."""
+        if bbox is None or client_key is None:
+            return
+        now = time.monotonic()
+        with self._embedding_cache_lock:
+            # Bỏ các client đã hết TTL để dict không lớn dần
+            for key in [k for k, v in self._last_frames.items() if now - v[0] > self.FRAME_REUSE_TTL]:
+                del self._last_frames[key]
+            self._last_frames[client_key] = (now, frame_hash, bbox, embedding)
+
+    def _represent(self, image: np.ndarray) -> Optional[np.ndarray]:
+        """Chạy model (DeepFace.represent) cho 1 ảnh khuôn mặt, không qua cache."""
         try:
+            if self._onnx_session is not None:
+                return self._represent_onnx([image])[0]
+
             # DeepFace yêu cầu đường dẫn ảnh hoặc numpy array (BGR)
             # enforce_detection=False vì ta đã detect bằng class FaceDetector rồi
             # Nếu dùng ảnh raw chưa crop thì để True
             
-            embedding_objs = DeepFace.represent(
-                img_path=image,
-                model_name=self.model_name,
-                detector_backend="skip", # Đã crop rồi nên skip detection của DeepFace
-                enforce_detection=False,
-                align=False # Đã align rồi
-            )
+            with _device_scope():
+                embedding_objs = DeepFace.represent(
+                    img_path=image,
+                    model_name=self.model_name,
+                    detector_backend="skip", # Đã crop rồi nên skip detection của DeepFace
+                    enforce_detection=False,
+                    align=False # Đã align rồi
+                )
             
             if embedding_objs and len(embedding_objs) > 0:
-                return embedding_objs[0]["embedding"]
+                return _as_embedding(embedding_objs[0]["embedding"])
             return None
             
         except Exception as e:
             logger.error(f"Error extracting embedding: {e}")
             return None
 
+    def extract_embedding(self, image: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Tạo vector embedding (np.ndarray float32 (D,)) từ ảnh khuôn mặt
+        (có LRU cache theo nội dung ảnh).
+        """
+        key = _image_key(image)
+        embedding = self._cache_get(key)
+        if embedding is None:
+            embedding = self._represent(image)
+            if embedding is not None:
+                self._cache_put(key, embedding)
+        return embedding
+
+    def extract_embedding_batch(self, images: List[np.ndarray]) -> List[Optional[np.ndarray]]:
+        """
+        Tạo embedding cho nhiều ảnh khuôn mặt trong 1 lần forward (ảnh đã có
+        trong cache thì bỏ qua). Các crop được letterbox (giữ tỉ lệ, pad 0) về
+        input của model và stack thành mảng (B, H, W, 3) uint8; nếu phiên bản
+        DeepFace không hỗ trợ input dạng batch thì xử lý từng ảnh.
+        """
+        keys = [_image_key(image) for image in images]
+        results = [self._cache_get(key) for key in keys]
+        misses = [i for i, embedding in enumerate(results) if embedding is None]
+        if not misses:
+            return results
+        
+        if len(misses) == 1:
+            computed = [self._represent(images[misses[0]])]
+        elif self._onnx_session is not None:
+            try:
+                computed = self._represent_onnx([images[i] for i in misses])
+            except Exception as e:
+                logger.error(f"Error extracting embeddings (ONNX): {e}")
+                computed = [None] * len(misses)
+        else:
+            try:
+                if self.input_size is None:
+                    raise ValueError("model input size unknown")
+                batch = np.stack([self._letterbox(images[i]) for i in misses]).astype(np.uint8, copy=False)
+                with _device_scope():
+                    batch_objs = DeepFace.represent(
+                        img_path=batch,
+                        model_name=self.model_name,
+                        detector_backend="skip",
+                        enforce_detection=False,
+                        align=False
+                    )
+                if len(batch_objs) != len(misses):
+                    raise ValueError(f"expected {len(misses)} results, got {len(batch_objs)}")
+                computed = [_as_embedding(objs[0]["embedding"]) if objs else None for objs in batch_objs]
+            except Exception as e:
+                logger.debug(f"Batched represent unavailable, falling back to per-image: {e}")
+                computed = [self._represent(images[i]) for i in misses]
+        
+        for i, embedding in zip(misses, computed):
+            results[i] = embedding
+            if embedding is not None:
+                self._cache_put(keys[i], embedding)
+        return results
+
+    # Tên ngắn cho API batch
+    extract_embeddings = extract_embedding_batch
+
     @staticmethod
     def cosine_similarity(source_representation: List[float], test_representation: List[float]) -> float:
         """
         Tính độ tương đồng Cosine giữa 2 vector.
         Output: -1.0 đến 1.0 (1.0 là giống hệt nhau)
         """
-        a = np.matmul(np.transpose(source_representation), test_representation)
-        b = np.sum(np.multiply(source_representation, source_representation))
-        c = np.sum(np.multiply(test_representation, test_representation))
-        return 1 - (a / (np.sqrt(b) * np.sqrt(c))) # DeepFace trả về distance (càng nhỏ càng tốt), ta convert sang distance
+        a = np.ascontiguousarray(source_representation, dtype=np.float32)
+        b = np.ascontiguousarray(test_representation, dtype=np.float32)
+        # DeepFace trả về distance (càng nhỏ càng tốt), ta convert sang distance
+        return 1.0 - float(np.dot(a, b) / np.sqrt(np.vdot(a, a) * np.vdot(b, b)))
+
+    @staticmethod
+    def _build_index(database_embeddings: Dict[int, List[float]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Chuyển dict {employee_id: vector} thành (ids (N,), M float32 (N, D)),
+        mỗi dòng của M đã L2-normalize.
+        """
+        ids = np.fromiter(database_embeddings.keys(), dtype=np.int64, count=len(database_embeddings))
+        M = np.asarray(list(database_embeddings.values()), dtype=np.float32)
+        norms = np.linalg.norm(M, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return ids, M / norms
 
     @staticmethod
     def find_best_match(
-        target_embedding: List[float], 
+        target_embedding: np.ndarray, 
         database_embeddings: Dict[int, List[float]],
-        threshold: float = 0.4 # Ngưỡng distance (ArcFace thường là 0.68, nhưng ta để chặt hơn)
+        threshold: float = 0.6 # Ngưỡng similarity (tương đương distance < 0.4)
     ) -> Tuple[Optional[int], float]:
         """
-        Tìm người giống nhất trong database.
+        Tìm người giống nhất trong database (1 phép nhân ma trận trên bản
+        normalize của dict; gọi nhiều lần thì dùng find_best_match_matrix
+        với ma trận đã cache, xem db_utils.get_embedding_matrix).
         
         Args:
             target_embedding: Vector cần tìm
             database_embeddings: Dict {employee_id: vector}
-            threshold: Ngưỡng chấp nhận (Cosine Distance). 
-                       Với ArcFace: < 0.68 là cùng 1 người.
-                       Càng thấp càng chặt chẽ.
+            threshold: Ngưỡng chấp nhận (Cosine Similarity). 
+                       Với ArcFace: > 0.32 (distance < 0.68) là cùng 1 người.
+                       Càng cao càng chặt chẽ.
         
         Returns:
-            (employee_id, distance) hoặc (None, min_distance)
+            (employee_id, similarity) hoặc (None, max_similarity)
         """
-        min_dist = float("inf")
-        best_id = None
+        if not database_embeddings:
+            return None, 0.0
+
+        ids, M = DeepFaceRecognizer._build_index(database_embeddings)
+        q = np.asarray(target_embedding, dtype=np.float32)
+        scores = M @ (q / np.linalg.norm(q))
+        i = int(scores.argmax())
+        best_sim = float(scores[i])
+        if best_sim > threshold:
+            return int(ids[i]), best_sim
+        return None, best_sim
+
+    def find_best_match_matrix(
+        self,
+        target_embedding: np.ndarray,
+        emp_ids: np.ndarray,
+        emb_matrix: np.ndarray,
+        threshold: float = 0.6
+    ) -> Tuple[Optional[int], float]:
+        """
+        Như find_best_match nhưng so khớp với ma trận embedding đã L2-normalize
+        (xem db_utils.get_embedding_matrix): 1 phép nhân ma trận thay vì loop Python.
         
-        for emp_id, db_emb in database_embeddings.items():
-            # Tính Cosine Distance (DeepFace dùng distance, không phải similarity)
-            # Distance = 1 - Cosine Similarity
-            
-            a = np.array(target_embedding)
-            b = np.array(db_emb)
-            
-            # Manual cosine distance calculation to be safe
-            dot = np.dot(a, b)
-            norma = np.linalg.norm(a)
-            normb = np.linalg.norm(b)
-            cos_sim = dot / (norma * normb)
-            dist = 1 - cos_sim
-            
-            if dist < min_dist:
-                min_dist = dist
-                best_id = emp_id
-                
-        if min_dist < threshold:
-            return best_id, min_dist
+        Args:
+            target_embedding: Vector cần tìm
+            emp_ids: np.ndarray (N,) employee_id tương ứng từng dòng
+            emb_matrix: np.ndarray float32 (N, D), mỗi dòng đã normalize
+            threshold: Ngưỡng Cosine Similarity
         
-        return None, min_dist
+        Returns:
+            (employee_id, similarity) hoặc (None, max_similarity)
+        """
+        if len(emp_ids) == 0:
+            return None, 0.0
+
+        q = np.asarray(target_embedding, dtype=np.float32)
+        q = q / np.linalg.norm(q)
+        ann_index = self._get_ann_index(emb_matrix) if self.use_ann and len(emp_ids) >= self.ANN_MIN_SIZE else None
+        if ann_index is not None:
+            i, best_sim = self._match_ann(q, emb_matrix, ann_index)
+        elif self.matcher == "numba":
+            i, best_sim = _cos_match(np.ascontiguousarray(emb_matrix, dtype=np.float32), q)
+            i = int(i)
+        elif self.matcher == "int8":
+            i, best_sim = self._match_int8(q, emb_matrix)
+        elif self.matcher == "simsimd":
+            M = np.ascontiguousarray(emb_matrix, dtype=np.float32)
+            dists = np.asarray(simsimd.cdist(q[None, :], M, metric="cosine")).ravel()
+            i = int(dists.argmin())
+            best_sim = 1.0 - dists[i]
+        else:
+            scores = emb_matrix @ q
+            i = int(scores.argmax())
+            best_sim = scores[i]
+        best_sim = float(best_sim)
+
+        if best_sim > threshold:
+            return int(emp_ids[i]), best_sim
+        return None, best_sim
+
+    def _match_int8(self, q: np.ndarray, emb_matrix: np.ndarray) -> Tuple[int, float]:
+        """
+        So khớp trên bản int8 của emb_matrix (lượng tử hóa 1 lần, cache theo
+        ma trận nguồn). Dùng kernel i8 của SimSIMD nếu có, ngược lại dot int32
+        rồi dequant bằng scales.
+        """
+        cached = self._int8_index
+        if cached is None or cached[0] is not emb_matrix:
+            cached = (emb_matrix, *quantize_int8(emb_matrix))
+            self._int8_index = cached
+        _, Q, scales = cached
+
+        qt, t_scale = quantize_int8(q)
+        if simsimd is not None:
+            dists = np.asarray(simsimd.cdist(qt, Q, metric="cosine")).ravel()
+            i = int(dists.argmin())
+            return i, 1.0 - dists[i]
+        scores = (Q.astype(np.int32) @ qt[0].astype(np.int32)) * scales * t_scale[0]
+        i = int(scores.argmax())
+        return i, scores[i]
+
+    def _get_ann_index(self, emb_matrix: np.ndarray):
+        """
+        Trả về index HNSW của emb_matrix nếu đã build xong, ngược lại None và
+        khởi động build ở thread nền (request hiện tại vẫn dùng brute force,
+        không phải chờ build vài giây).
+        """
+        cached = self._ann_index
+        if cached is not None and cached[0] is emb_matrix:
+            return cached[1]
+        with self._ann_lock:
+            if self._ann_building is None:
+                self._ann_building = emb_matrix
+                threading.Thread(
+                    target=self._build_ann_index, args=(emb_matrix,), name="hnsw-build", daemon=True
+                ).start()
+        return None
+
+    def _build_ann_index(self, emb_matrix: np.ndarray):
+        """Build index HNSW cho emb_matrix (chạy ở thread nền)."""
+        try:
+            n, dim = emb_matrix.shape
+            index = hnswlib.Index(space="cosine", dim=dim)
+            index.init_index(max_elements=n, ef_construction=200, M=16)
+            index.add_items(emb_matrix, np.arange(n))
+            index.set_ef(max(50, self.ANN_TOP_K))
+            self._ann_index = (emb_matrix, index)
+            logger.info(f"HNSW index built for {n} embeddings")
+        except Exception as e:
+            logger.error(f"Failed to build HNSW index: {e}")
+        finally:
+            with self._ann_lock:
+                self._ann_building = None
+
+    def _match_ann(self, q: np.ndarray, emb_matrix: np.ndarray, index) -> Tuple[int, float]:
+        """
+        So khớp 2 bước cho DB lớn: HNSW lấy ANN_TOP_K ứng viên, sau đó tính
+        cosine chính xác trên các dòng đó.
+        """
+        k = min(self.ANN_TOP_K, emb_matrix.shape[0])
+        labels, _ = index.knn_query(q, k=k)
+        candidates = labels[0].astype(np.int64)
+        scores = emb_matrix[candidates] @ q
+        best = int(scores.argmax())
+        return int(candidates[best]), scores[best]
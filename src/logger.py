@@ -4,9 +4,38 @@
 
 import logging
 import os
+import threading
 from datetime import datetime
 from typing import Optional
 
+# Thư mục log mặc định (tính 1 lần khi import)
+LOG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs')
+
+# Mỗi file log dùng chung 1 handler cho mọi logger trong process
+_file_handlers = {}
+_file_handlers_lock = threading.Lock()
+
+
+def _get_file_handler(log_file: str, level: int, formatter: logging.Formatter) -> logging.Handler:
+    """
+    Handler ghi file: FileHandler (delay=True, chỉ mở file khi ghi lần đầu),
+    mỗi record được ghi và flush ngay (tail -f thấy liền, không mất log khi
+    worker bị kill).
+    
+    Không xoay vòng trong process: nhiều worker gunicorn cùng append 1 file,
+    mỗi worker tự rotate sẽ đổi tên file của nhau. Xoay vòng bằng logrotate
+    bên ngoài (xem DEPLOYMENT.md).
+    """
+    with _file_handlers_lock:
+        handler = _file_handlers.get(log_file)
+        if handler is None:
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            handler = logging.FileHandler(log_file, encoding='utf-8', delay=True)
+            handler.setLevel(level)
+            handler.setFormatter(formatter)
+            _file_handlers[log_file] = handler
+        return handler
+
 
 def setup_logger(
     name: str,
@@ -48,11 +77,7 @@ def setup_logger(
     
     # File handler
     if log_file:
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        file_handler = logging.FileHandler(log_file, encoding='utf-8')
-        file_handler.setLevel(level)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        logger.addHandler(_get_file_handler(log_file, level, formatter))
     
     return logger
 
@@ -68,12 +93,14 @@ def get_logger(module_name: str) -> logging.Logger:
     Returns:
         Logger instance
     """
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    log_dir = os.path.join(base_dir, 'logs')
+    # Logger đã cấu hình: trả về luôn, không tính lại đường dẫn file log
+    logger = logging.getLogger(module_name)
+    if logger.handlers:
+        return logger
     
     # Tạo tên file log theo ngày
     date_str = datetime.now().strftime('%Y%m%d')
-    log_file = os.path.join(log_dir, f'app_{date_str}.log')
+    log_file = os.path.join(LOG_DIR, f'app_{date_str}.log')
     
     return setup_logger(
         name=module_name,
@@ -0,0 +1,83 @@
+# src/streamer.py
+
+"""Micro-batching: gom các request đồng thời thành 1 batch cho model."""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class Streamer:
+    """
+    Gom các input được gửi đồng thời (từ nhiều thread) thành batch và gọi
+    predict_batch 1 lần cho cả batch (kiểu service-streamer).
+
+    Usage:
+        streamer = Streamer(recognizer.extract_embedding_batch, batch_size=8, max_latency=0.01)
+        embedding = streamer.predict([aligned_face])[0]
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[List[Any]], List[Any]],
+        batch_size: int = 8,
+        max_latency: float = 0.01
+    ):
+        """
+        Args:
+            predict_batch: Hàm xử lý list input -> list output (cùng thứ tự)
+            batch_size: Số input tối đa mỗi batch
+            max_latency: Thời gian tối đa (giây) chờ gom batch
+        """
+        self.predict_batch = predict_batch
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="streamer", daemon=True)
+        self._worker.start()
+
+    def submit(self, item: Any) -> Future:
+        """Đưa 1 input vào hàng đợi, trả về Future chứa kết quả."""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def predict(self, items: List[Any]) -> List[Any]:
+        """Xử lý list input (blocking), trả về list kết quả cùng thứ tự."""
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _collect_batch(self) -> list:
+        """Lấy 1 batch: chờ input đầu tiên, sau đó gom thêm trong max_latency."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            items = [item for item, _ in batch]
+            try:
+                results = self.predict_batch(items)
+            except Exception as e:
+                logger.error(f"Batch prediction failed ({len(items)} items): {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)